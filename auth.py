@@ -1,256 +1,335 @@
 import sqlite3
-from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Optional, Tuple
+from fastapi import APIRouter, HTTPException, Depends, WebSocket
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import List, Dict, Optional
-import json
-from datetime import datetime
-from chat import broadcast_message
+import bcrypt
+from logs import get_logger
 
 router = APIRouter()
+logger = get_logger(__name__)
+
+DATABASE = "users.db"
+
+# Ключ подписи токенов. Без SECRET_KEY токены живут до перезапуска процесса
+SECRET_KEY = os.getenv("SECRET_KEY") or secrets.token_hex(32)
+SECRET_KEY_GENERATED = not os.getenv("SECRET_KEY")
+TOKEN_TTL = int(os.getenv("TOKEN_TTL", 7 * 24 * 3600))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 65536))
+# Пользователи с доступом к служебным эндпоинтам, через запятую
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+# Параметры хеширования паролей
+HASH_ALGORITHM = "pbkdf2_sha256"
+HASH_ITERATIONS = int(os.getenv("HASH_ITERATIONS", 600_000))
+# Хеширование идет в отдельных процессах, чтобы не блокировать event loop
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+# Сколько хеширований может ждать в очереди, остальные получают 503
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", HASH_WORKERS * 8))
+
+_hash_pool: Optional[ProcessPoolExecutor] = None
+_hash_slots = asyncio.Semaphore(HASH_QUEUE_LIMIT)
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+class UserCredentials(BaseModel):
+    username: str
+    password: str
+
+class TokenResponse(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    user_id: int
+
+# создание таблицы пользователей
+def create_users_table():
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            login TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        )
+    """)
+    conn.commit()
+    conn.close()
 
-DATABASE = "chats.db"
-USERS_DATABASE = "users.db"  # База данных с пользователями
-
-# Хранение WebSocket подключений
-connections: Dict[int, WebSocket] = {}
+create_users_table()
+
+# Выполняется в дочернем процессе
+def _pbkdf2(password: str, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+# Выполняется в дочернем процессе. Так хешировались пароли до перехода на PBKDF2
+def _bcrypt_check(password: str, stored: str) -> bool:
+    return bcrypt.checkpw(password.encode(), stored.encode())
+
+def _get_hash_pool() -> ProcessPoolExecutor:
+    global _hash_pool
+    if _hash_pool is None:
+        _hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+    return _hash_pool
+
+def shutdown_hash_pool():
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(wait=False, cancel_futures=True)
+        _hash_pool = None
+
+async def _run_hash(func, *args):
+    # Не копим бесконечную очередь: при перегрузке сразу отвечаем 503
+    if _hash_slots.locked():
+        raise HTTPException(status_code=503, detail="Сервер перегружен, попробуйте позже")
+    async with _hash_slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_hash_pool(), func, *args)
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+async def hash_password(password: str) -> str:
+    salt = os.urandom(16)
+    digest = await _run_hash(_pbkdf2, password, salt, HASH_ITERATIONS)
+    return f"{HASH_ALGORITHM}${HASH_ITERATIONS}${_b64encode(salt)}${_b64encode(digest)}"
+
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+
+async def verify_password(password: str, stored: str) -> bool:
+    if stored.startswith(BCRYPT_PREFIXES):
+        try:
+            return await _run_hash(_bcrypt_check, password, stored)
+        except ValueError:
+            return False
+    if stored.startswith(f"{HASH_ALGORITHM}$"):
+        # Поврежденная запись — это неверный пароль, а не ошибка сервера
+        try:
+            _, iterations, salt, digest = stored.split("$")
+            salt, digest, iterations = _b64decode(salt), _b64decode(digest), int(iterations)
+        except ValueError:
+            return False
+        candidate = await _run_hash(_pbkdf2, password, salt, iterations)
+        return hmac.compare_digest(candidate, digest)
+    # Самые старые записи хранят пароль открытым текстом
+    return hmac.compare_digest(password.encode(), stored.encode())
+
+# Для несуществующего логина проверяем пароль против этого хеша: ответ стоит
+# столько же, сколько для настоящего пользователя, и проходит ту же очередь
+_DUMMY_HASH = f"{HASH_ALGORITHM}${HASH_ITERATIONS}${_b64encode(os.urandom(16))}${_b64encode(os.urandom(32))}"
+
+def needs_rehash(stored: str) -> bool:
+    return not stored.startswith(f"{HASH_ALGORITHM}${HASH_ITERATIONS}$")
+
+# Вызывается при старте сервера, когда логирование уже настроено
+def check_secret_key():
+    if SECRET_KEY_GENERATED:
+        logger.warning(
+            "SECRET_KEY is not set: using a random key, tokens will be invalidated "
+            "on restart and rejected by other worker processes"
+        )
 
-class MessageCreate(BaseModel):
-    content: str
-    chat_id: int
-    sender_id: int
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(SECRET_KEY.encode(), payload.encode(), hashlib.sha256).digest())
 
-class MessageResponse(BaseModel):
-    id: int
-    content: str
-    sender_id: int
-    chat_id: int
-    created_at: str
-    sender_name: str
+def create_token(user_id: int) -> str:
+    payload = f"{user_id}.{int(time.time()) + TOKEN_TTL}"
+    return f"{payload}.{_sign(payload)}"
 
-def get_user_name(user_id: int) -> str:
+# Подпись проверяется один раз на токен, дальше — только срок действия
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _decode_token(token: str) -> Optional[Tuple[int, int]]:
     try:
-        conn = sqlite3.connect(USERS_DATABASE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT login FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else "Unknown User"
-    except Exception as e:
-        print(f"Error getting username: {e}")
-        return "Unknown User"
-
-def setup_database():
-    with sqlite3.connect(DATABASE) as conn:
-        # Создаем временную таблицу с правильной структурой
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS messages_new (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            content TEXT NOT NULL,
-            sender_id INTEGER NOT NULL,
-            chat_id INTEGER NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (chat_id) REFERENCES chats (id)
+        user_id, expires, signature = token.split(".")
+        if not hmac.compare_digest(signature, _sign(f"{user_id}.{expires}")):
+            return None
+        return int(user_id), int(expires)
+    except ValueError:
+        return None
+
+def verify_token(token: Optional[str]) -> Optional[int]:
+    if not token:
+        return None
+    decoded = _decode_token(token)
+    if decoded is None or decoded[1] < time.time():
+        return None
+    return decoded[0]
+
+def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> int:
+    user_id = verify_token(credentials.credentials if credentials else None)
+    if user_id is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Требуется авторизация",
+            headers={"WWW-Authenticate": "Bearer"},
         )
-        """)
+    return user_id
 
-        # Проверяем существование старой таблицы
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'")
-        if cursor.fetchone():
-            # Копируем данные из старой таблицы в новую
-            try:
-                conn.execute("""
-                INSERT INTO messages_new (id, content, sender_id, chat_id, created_at)
-                SELECT id, content, sender_id, chat_id, COALESCE(created_at, CURRENT_TIMESTAMP)
-                FROM messages
-                """)
-                # Удаляем старую таблицу
-                conn.execute("DROP TABLE messages")
-            except sqlite3.OperationalError:
-                # Если что-то пошло не так, просто создаем новую таблицу
-                conn.execute("DROP TABLE IF EXISTS messages")
-
-        # Переименовываем новую таблицу
-        conn.execute("ALTER TABLE messages_new RENAME TO messages")
-
-setup_database()
-
-# WebSocket подключение
-@router.websocket("/ws/{user_id}")
-async def websocket_chat(websocket: WebSocket, user_id: int):
-    await websocket.accept()
-    connections[user_id] = websocket
+def get_admin_user(current_user: int = Depends(get_current_user)) -> int:
+    if current_user not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+    return current_user
 
-    try:
-        while True:
-            # Ожидаем сообщение от клиента
-            message = await websocket.receive_json()
-
-            # Сохраняем сообщение в БД
-            with sqlite3.connect(DATABASE) as conn:
-                cursor = conn.cursor()
-                now = datetime.now().isoformat()
-
-                cursor.execute(
-                    """INSERT INTO messages (chat_id, sender_id, content, created_at) 
-                    VALUES (?, ?, ?, ?)""",
-                    (message["chat_id"], user_id, message["content"], now)
-                )
-
-                msg_id = cursor.lastrowid
-
-                # Отправляем сообщение всем подключенным пользователям
-                new_message = {
-                    "id": msg_id,
-                    "chat_id": message["chat_id"],
-                    "sender_id": user_id,
-                    "content": message["content"],
-                    "created_at": now
-                }
-
-                for connection in connections.values():
-                    await connection.send_json(new_message)
-
-    except WebSocketDisconnect:
-        # Удаляем соединение при отключении
-        if user_id in connections:
-            del connections[user_id]
-
-# HTTP эндпоинты
-@router.post("/", response_model=MessageResponse)
-async def create_message(message: MessageCreate):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+def ensure_same_user(current_user: int, user_id: Optional[int]):
+    if user_id is not None and user_id != current_user:
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
 
-    try:
-        # Проверяем существование чата
-        cursor.execute("SELECT id FROM chats WHERE id = ?", (message.chat_id,))
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="Чат не найден")
+# Токен для WebSocket передается в query-параметре ?token=
+async def authenticate_websocket(websocket: WebSocket, user_id: int) -> bool:
+    if verify_token(websocket.query_params.get("token")) != user_id:
+        await websocket.close(code=1008)
+        return False
+    return True
 
-        # Получаем имя отправителя из базы данных пользователей
-        sender_name = get_user_name(message.sender_id)
+@router.post("/register", response_model=TokenResponse)
+async def register_user(credentials: UserCredentials):
+    if not credentials.username or not credentials.password:
+        raise HTTPException(status_code=400, detail="Логин и пароль обязательны")
 
-        # Создаем сообщение
-        cursor.execute(
-            "INSERT INTO messages (content, sender_id, chat_id) VALUES (?, ?, ?)",
-            (message.content, message.sender_id, message.chat_id)
-        )
-        message_id = cursor.lastrowid
+    password_hash = await hash_password(credentials.password)
 
-        # Получаем созданное сообщение
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    try:
         cursor.execute(
-            "SELECT * FROM messages WHERE id = ?",
-            (message_id,)
+            "INSERT INTO users (login, password) VALUES (?, ?)",
+            (credentials.username, password_hash)
         )
-        message_data = cursor.fetchone()
+        user_id = cursor.lastrowid
         conn.commit()
-
-        # Формируем ответ
-        response = {
-            "id": message_data[0],
-            "content": message_data[1],
-            "sender_id": message_data[2],
-            "chat_id": message_data[3],
-            "created_at": message_data[4],
-            "sender_name": sender_name
-        }
-
-        # Отправляем сообщение через WebSocket
-        await broadcast_message(message.chat_id, response)
-
-        return response
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=400, detail="Пользователь уже существует")
     finally:
         conn.close()
 
-@router.get("/", response_model=List[MessageResponse])
-async def get_messages(chat_id: int):
+    return {"access_token": create_token(user_id), "token_type": "bearer", "user_id": user_id}
+
+@router.post("/login", response_model=TokenResponse)
+async def login_user(credentials: UserCredentials):
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
-
     try:
-        cursor.execute("""
-            SELECT m.* FROM messages m
-            WHERE m.chat_id = ?
-            ORDER BY m.created_at ASC
-        """, (chat_id,))
-        messages = cursor.fetchall()
-
-        return [
-            {
-                "id": msg[0],
-                "content": msg[1],
-                "sender_id": msg[2],
-                "chat_id": msg[3],
-                "created_at": msg[4],
-                "sender_name": get_user_name(msg[2])
-            }
-            for msg in messages
-        ]
+        cursor.execute("SELECT id, password FROM users WHERE login = ?", (credentials.username,))
+        user = cursor.fetchone()
     finally:
         conn.close()
 
-@router.put("/edit")
-async def edit_message(message_id: int, new_content: str):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-
-    # Получаем информацию о сообщении
-    cursor.execute("SELECT chat_id, sender_id FROM messages WHERE id = ?", (message_id,))
-    message_info = cursor.fetchone()
-
-    if not message_info:
-        raise HTTPException(status_code=404, detail="Сообщение не найдено")
-
-    chat_id, sender_id = message_info
-
-    # Обновляем сообщение
-    cursor.execute(
-        "UPDATE messages SET content = ?, created_at = ? WHERE id = ?",
-        (new_content, datetime.now().isoformat(), message_id)
-    )
-    conn.commit()
-    conn.close()
-
-    # Отправляем обновленное сообщение через WebSocket
-    for user_id, connection in connections.items():
-        await connection.send_json({
-            "type": "message_edit",
-            "id": message_id,
-            "chat_id": chat_id,
-            "sender_id": sender_id,
-            "content": new_content,
-            "created_at": datetime.now().isoformat()
-        })
-
-    return {"message": "Сообщение изменено"}
-
-@router.delete("/delete")
-async def delete_message(message_id: int):
+    if not user:
+        await verify_password(credentials.password, _DUMMY_HASH)
+        raise HTTPException(status_code=401, detail="Неверный логин или пароль")
+    if not await verify_password(credentials.password, user[1]):
+        raise HTTPException(status_code=401, detail="Неверный логин или пароль")
+
+    user_id, stored = user
+    # Переводим старые записи на актуальный хеш
+    if needs_rehash(stored):
+        password_hash = await hash_password(credentials.password)
+        conn = sqlite3.connect(DATABASE)
+        try:
+            conn.execute("UPDATE users SET password = ? WHERE id = ?", (password_hash, user_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    return {"access_token": create_token(user_id), "token_type": "bearer", "user_id": user_id}
+
+@router.get("/me")
+async def read_current_user(current_user: int = Depends(get_current_user)):
+    return {"user_id": current_user}
+
+# Шторм логинов: concurrency одновременных /login, пока не наберется logins.
+# Параллельно тикер раз в LAG_TICK секунд меряет, насколько event loop
+# опаздывает его разбудить
+LAG_TICK = 0.005
+
+async def _bench_logins(logins: int, concurrency: int) -> dict:
+    password_hash = await hash_password("password")
     conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-
-    # Получаем информацию о сообщении
-    cursor.execute("SELECT chat_id, sender_id FROM messages WHERE id = ?", (message_id,))
-    message_info = cursor.fetchone()
-
-    if not message_info:
-        raise HTTPException(status_code=404, detail="Сообщение не найдено")
-
-    chat_id, sender_id = message_info
-
-    # Удаляем сообщение
-    cursor.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+    conn.execute("INSERT INTO users (login, password) VALUES (?, ?)", ("bench", password_hash))
     conn.commit()
     conn.close()
 
-    # Отправляем уведомление об удалении через WebSocket
-    for user_id, connection in connections.items():
-        await connection.send_json({
-            "type": "message_delete",
-            "id": message_id,
-            "chat_id": chat_id,
-            "sender_id": sender_id
-        })
+    lags = []
+    async def tick():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LAG_TICK)
+            lags.append(time.perf_counter() - started - LAG_TICK)
+
+    statuses = {}
+    queue = iter(range(logins))
+    async def client():
+        for _ in queue:
+            try:
+                await login_user(UserCredentials(username="bench", password="password"))
+                status = 200
+            except HTTPException as error:
+                status = error.status_code
+            statuses[status] = statuses.get(status, 0) + 1
+
+    ticker = asyncio.get_running_loop().create_task(tick())
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    # Даем тикеру проснуться: если loop был заблокирован все время, это первый замер
+    await asyncio.sleep(LAG_TICK * 2)
+    ticker.cancel()
+
+    lags.sort()
+    return {
+        "logins_per_second": logins / elapsed,
+        "statuses": statuses,
+        "lag_p50_ms": statistics.median(lags) * 1000,
+        "lag_p99_ms": lags[int(len(lags) * 0.99)] * 1000,
+        "lag_max_ms": lags[-1] * 1000,
+    }
+
+def main():
+    global DATABASE, HASH_ITERATIONS, _run_hash
+    parser = argparse.ArgumentParser(description="Аутентификация")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    bench_parser = commands.add_parser("bench", help="задержка event loop под штормом логинов")
+    bench_parser.add_argument("--logins", type=int, default=200)
+    bench_parser.add_argument("--concurrency", type=int, default=50)
+    bench_parser.add_argument("--iterations", type=int, default=HASH_ITERATIONS)
+    bench_parser.add_argument("--inline", action="store_true", help="хешировать прямо в event loop, для сравнения")
+
+    args = parser.parse_args()
+    HASH_ITERATIONS = args.iterations
+    if args.inline:
+        async def _run_inline(func, *func_args):
+            return func(*func_args)
+        _run_hash = _run_inline
+
+    with tempfile.TemporaryDirectory() as directory:
+        DATABASE = os.path.join(directory, "users.db")
+        create_users_table()
+        try:
+            result = asyncio.run(_bench_logins(args.logins, args.concurrency))
+        finally:
+            shutdown_hash_pool()
+    print(
+        f"{result['logins_per_second']:,.1f} logins/s, statuses {result['statuses']}, "
+        f"loop lag p50 {result['lag_p50_ms']:.1f} ms, p99 {result['lag_p99_ms']:.1f} ms, "
+        f"max {result['lag_max_ms']:.1f} ms"
+    )
 
-    return {"message": "Сообщение удалено"}
\ No newline at end of file
+if __name__ == "__main__":
+    from logs import setup_logging
+    setup_logging()
+    main()
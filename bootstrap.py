@@ -0,0 +1,86 @@
+import sqlite3
+from typing import Iterator
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from auth import get_current_user
+import shards
+from message import DATABASE
+from ratelimit import chats_list_slots, concurrency_limit
+from responses import dumps
+
+router = APIRouter()
+
+# Чаты пользователя с отметкой о прочтении
+CHATS_QUERY = """
+    SELECT c.id, c.name, c.creator_id, c.is_group, cp.joined_at, cp.last_read_id
+    FROM chat_participants cp
+    JOIN chats c ON c.id = cp.chat_id
+    WHERE cp.user_id = ?
+"""
+
+def render_message(row) -> dict:
+    msg_id, content, sender_id, chat_id, created_at, sender_name = row
+    return {
+        "id": msg_id,
+        "content": content,
+        "sender_id": sender_id,
+        "chat_id": chat_id,
+        "created_at": created_at,
+        "sender_name": sender_name
+    }
+
+# Число запросов не зависит от числа чатов: один к chats.db и по три на шард
+# (последние сообщения, непрочитанные, лента горячих чатов). Ответ пишется
+# частями: сначала список чатов, затем сообщения, сгруппированные по чатам
+def stream_bootstrap(user_id: int, top_chats: int, per_chat: int) -> Iterator[bytes]:
+    conn = sqlite3.connect(DATABASE)
+    try:
+        chats = conn.execute(CHATS_QUERY, (user_id,)).fetchall()
+    finally:
+        conn.close()
+
+    last = shards.last_messages([chat[0] for chat in chats])
+    unread = shards.unread_counts({chat[0]: chat[5] for chat in chats}, user_id)
+    no_message = (None, None, None, None)
+    chats.sort(key=lambda chat: last.get(chat[0], no_message)[3] or chat[4], reverse=True)
+
+    yield b'{"user_id":' + dumps(user_id) + b',"chats":['
+    for index, (chat_id, name, creator_id, is_group, _, _) in enumerate(chats):
+        last_id, last_content, last_sender, last_time = last.get(chat_id, no_message)
+        yield (b"," if index else b"") + dumps({
+            "id": chat_id,
+            "name": name,
+            "creator_id": creator_id,
+            "is_group": bool(is_group),
+            "last_message": last_content,
+            "last_message_time": last_time,
+            "last_message_id": last_id,
+            "last_message_sender_id": last_sender,
+            "unread_count": unread.get(chat_id, 0)
+        })
+    yield b'],"messages":{'
+
+    hot_chat_ids = [chat[0] for chat in chats[:top_chats]]
+    if hot_chat_ids and per_chat > 0:
+        recent = shards.recent_messages(hot_chat_ids, per_chat)
+        first = True
+        for chat_id in hot_chat_ids:
+            if chat_id not in recent:
+                continue
+            yield (b"" if first else b",") + dumps(str(chat_id)) + b":" + dumps(
+                [render_message(row) for row in recent[chat_id]]
+            )
+            first = False
+    yield b"}}"
+
+# Все, что нужно клиенту при запуске, одним запросом
+@router.get("/", dependencies=[Depends(concurrency_limit(chats_list_slots))])
+def get_bootstrap(
+    top_chats: int = Query(10, ge=0, le=100),
+    per_chat: int = Query(30, ge=0, le=200),
+    current_user: int = Depends(get_current_user),
+):
+    return StreamingResponse(
+        stream_bootstrap(current_user, top_chats, per_chat),
+        media_type="application/json"
+    )
@@ -1,12 +1,19 @@
 import sqlite3
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Depends
 from pydantic import BaseModel
 from typing import Optional, List, Dict
 import json
 from datetime import datetime
 import ssl
+from heartbeat import register, touch, unregister, send_or_drop, close_session
+from auth import get_current_user, ensure_same_user, authenticate_websocket
+from ratelimit import connection_limiter, chats_list_slots, concurrency_limit
+from logs import get_logger, SAMPLED
+from responses import FastJSONResponse
+from shards import last_messages
 
 router = APIRouter()
+logger = get_logger(__name__)
 
 DATABASE = "chats.db"
 
@@ -24,6 +31,10 @@ class ChatUpdate(BaseModel):
     name: Optional[str] = None
     avatar_url: Optional[str] = None
 
+class ChatRead(BaseModel):
+    chat_id: int
+    message_id: int
+
 class ChatResponse(BaseModel):
     id: int
     name: str
@@ -58,6 +69,16 @@ def create_chats_table():
         )
     """)
 
+    # Последнее прочитанное сообщение — для подсчета непрочитанных
+    cursor.execute("PRAGMA table_info(chat_participants)")
+    if "last_read_id" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute(
+            "ALTER TABLE chat_participants ADD COLUMN last_read_id INTEGER NOT NULL DEFAULT 0"
+        )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat_participants_user ON chat_participants (user_id)"
+    )
+
     conn.commit()
     conn.close()
 
@@ -76,64 +97,83 @@ async def add_chat_participant(chat_id: int, user_id: int):
     finally:
         conn.close()
 
-@router.get("/list", response_model=List[ChatResponse])
-async def get_chats(user_id: int = None):
-    if user_id is None:
-        raise HTTPException(status_code=400, detail="user_id is required")
+# Проверка, что пользователь состоит в чате
+def is_chat_participant(chat_id: int, user_id: int) -> bool:
+    conn = sqlite3.connect(DATABASE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT 1 FROM chat_participants WHERE chat_id = ? AND user_id = ?",
+            (chat_id, user_id)
+        )
+        return cursor.fetchone() is not None
+    finally:
+        conn.close()
+
+def get_chat_participants(chat_id: int) -> List[int]:
+    conn = sqlite3.connect(DATABASE)
+    try:
+        cursor = conn.execute("SELECT user_id FROM chat_participants WHERE chat_id = ?", (chat_id,))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+@router.get("/list", response_model=List[ChatResponse], dependencies=[Depends(concurrency_limit(chats_list_slots))])
+async def get_chats(user_id: int = None, current_user: int = Depends(get_current_user)):
+    # user_id оставлен для совместимости, но должен совпадать с владельцем токена
+    ensure_same_user(current_user, user_id)
+    # fetch_chats уже формирует строки в формате ChatResponse
+    return FastJSONResponse(await fetch_chats(current_user))
 
+async def fetch_chats(user_id: int):
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
     try:
-        print(f"Getting chats for user {user_id}")
+        logger.debug("Getting chats for user %s", user_id, extra=SAMPLED)
         # Получаем все чаты пользователя
         cursor.execute("""
-            SELECT DISTINCT c.id, c.name, c.creator_id, c.is_group,
-                   m.content, m.created_at
+            SELECT c.id, c.name, c.creator_id, c.is_group, cp.joined_at
             FROM chats c
-            LEFT JOIN chat_participants cp ON c.id = cp.chat_id
-            LEFT JOIN (
-                SELECT chat_id, content, created_at
-                FROM messages
-                WHERE (chat_id, created_at) IN (
-                    SELECT chat_id, MAX(created_at)
-                    FROM messages
-                    GROUP BY chat_id
-                )
-            ) m ON c.id = m.chat_id
+            JOIN chat_participants cp ON c.id = cp.chat_id
             WHERE cp.user_id = ?
-            ORDER BY COALESCE(m.created_at, cp.joined_at) DESC
         """, (user_id,))
 
         chats = cursor.fetchall()
-        print(f"Found {len(chats)} chats for user {user_id}")
-
-        result = [
-            {
-                "id": chat[0],
-                "name": chat[1],
-                "creator_id": chat[2],
-                "is_group": bool(chat[3]),
-                "last_message": chat[4] if chat[4] is not None else None,
-                "last_message_time": chat[5] if chat[5] is not None else None
-            }
-            for chat in chats
-        ]
-        print(f"Returning chats: {result}")
+        logger.debug("Found %d chats for user %s", len(chats), user_id, extra=SAMPLED)
+
+        # Последние сообщения собираем со всех шардов, где лежат чаты пользователя
+        last = last_messages([chat[0] for chat in chats])
+        rows = []
+        for chat_id, name, creator_id, is_group, joined_at in chats:
+            _, last_message, _, last_message_time = last.get(chat_id, (None, None, None, None))
+            rows.append((last_message_time or joined_at, {
+                "id": chat_id,
+                "name": name,
+                "creator_id": creator_id,
+                "is_group": bool(is_group),
+                "last_message": last_message,
+                "last_message_time": last_message_time
+            }))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        result = [chat for _, chat in rows]
+        logger.debug("Returning chats for user %s: %s", user_id, result, extra=SAMPLED)
         return result
     except Exception as e:
-        print(f"Error getting chats for user {user_id}: {e}")
+        logger.exception("Error getting chats for user %s", user_id)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         conn.close()
 
 @router.post("/create", response_model=dict)
-async def create_chat(chat: ChatCreate):
+async def create_chat(chat: ChatCreate, current_user: int = Depends(get_current_user)):
+    ensure_same_user(current_user, chat.creator_id)
+
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
     try:
-        print(f"Creating chat with name: {chat.name}, creator: {chat.creator_id}")
+        logger.info("Creating chat with name: %s, creator: %s", chat.name, chat.creator_id)
         cursor.execute(
             "INSERT INTO chats (name, creator_id, is_group) VALUES (?, ?, ?)",
             (chat.name, chat.creator_id, chat.is_group)
@@ -159,25 +199,26 @@ async def create_chat(chat: ChatCreate):
         # Получаем обновленный список чатов для всех участников
         all_participants = [chat.creator_id] + [p for p in chat.participants if p != chat.creator_id]
         for participant_id in all_participants:
-            participant_chats = await get_chats(user_id=participant_id)
+            participant_chats = await fetch_chats(participant_id)
             if participant_id in active_connections:
-                try:
-                    await active_connections[participant_id].send_json({
-                        "type": "chats_update",
-                        "chats": participant_chats
-                    })
-                except Exception as e:
-                    print(f"Error sending update to participant {participant_id}: {e}")
+                if not await send_or_drop(active_connections[participant_id], {
+                    "type": "chats_update",
+                    "chats": participant_chats
+                }):
+                    logger.warning("Error sending update to participant %s", participant_id)
 
         return {"id": chat_id, "message": "Чат успешно создан"}
     except Exception as e:
-        print(f"Error creating chat: {e}")
+        logger.exception("Error creating chat")
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         conn.close()
 
 @router.post("/update")
-async def update_chat(chat: ChatUpdate):
+async def update_chat(chat: ChatUpdate, current_user: int = Depends(get_current_user)):
+    if not is_chat_participant(chat.chat_id, current_user):
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
@@ -194,37 +235,76 @@ async def update_chat(chat: ChatUpdate):
     conn.close()
 
     # Отправляем уведомление об обновлении списка чатов всем подключенным пользователям
-    chats = await get_chats()
-    for connection in active_connections.values():
-        await connection.send_json({
+    for participant_id, connection in list(active_connections.items()):
+        await send_or_drop(connection, {
             "type": "chats_update",
-            "chats": chats
+            "chats": await fetch_chats(participant_id)
         })
 
     return {"message": "Чат успешно обновлен"}
 
+@router.post("/read")
+async def mark_chat_read(read: ChatRead, current_user: int = Depends(get_current_user)):
+    conn = sqlite3.connect(DATABASE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE chat_participants SET last_read_id = MAX(last_read_id, ?)
+            WHERE chat_id = ? AND user_id = ?""",
+            (read.message_id, read.chat_id, current_user)
+        )
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=404, detail="Чат не найден")
+        conn.commit()
+    finally:
+        conn.close()
+
+    return {"message": "Чат отмечен как прочитанный"}
+
 @router.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int):
+    if not await authenticate_websocket(websocket, user_id):
+        return
+
     try:
         await websocket.accept()
-        active_connections[user_id] = websocket
+        register(active_connections, user_id, websocket)
 
         while True:
             try:
                 data = await websocket.receive_text()
+
+                # Флуд в одном подключении — закрываем его. Учитываются все кадры,
+                # включая pong и некорректный JSON
+                if not connection_limiter.allow(id(websocket)):
+                    await close_session(websocket, code=1008)
+                    break
+
                 message = json.loads(data)
 
+                if message["type"] == "pong":
+                    # Ответ на heartbeat — соединение живо, но не активно
+                    touch(websocket, active=False)
+                    continue
+                touch(websocket)
+
                 if message["type"] == "request_update":
                     # Получаем обновленный список чатов
-                    chats = await get_chats()
+                    chats = await fetch_chats(user_id)
                     await websocket.send_json({
                         "type": "chats_update",
                         "chats": chats
                     })
                 elif message["type"] == "join_chat":
-                    # Пользователь присоединяется к чату
+                    # Участников задает создатель чата, вступить в чужой чат нельзя
                     chat_id = message["chat_id"]
-                    await add_chat_participant(chat_id, user_id)
+                    if not is_chat_participant(chat_id, user_id):
+                        await send_or_drop(websocket, {
+                            "type": "error",
+                            "detail": "Доступ запрещен",
+                            "chat_id": chat_id
+                        })
+                        continue
                     await websocket.send_json({
                         "type": "chat_joined",
                         "chat_id": chat_id
@@ -237,21 +317,20 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int):
                         "chat_id": chat_id
                     })
             except json.JSONDecodeError:
-                print(f"Invalid JSON received from user {user_id}")
+                logger.warning("Invalid JSON received from user %s", user_id, extra=SAMPLED)
                 continue
-            except WebSocketDisconnect:
-                break  # Выходим из цикла при отключении
-            except Exception as e:
-                print(f"Error processing message from user {user_id}: {e}")
+            except (WebSocketDisconnect, RuntimeError):
+                break  # Выходим из цикла при отключении или закрытии сокета
+            except Exception:
+                logger.exception("Error processing message from user %s", user_id)
                 continue
 
     except WebSocketDisconnect:
-        if user_id in active_connections:
-            del active_connections[user_id]
-    except Exception as e:
-        print(f"WebSocket error for user {user_id}: {e}")
-        if user_id in active_connections:
-            del active_connections[user_id]
+        pass
+    except Exception:
+        logger.exception("WebSocket error for user %s", user_id)
+    finally:
+        unregister(websocket)
 
 # Функция для отправки сообщения всем подключенным пользователям чата
 async def broadcast_message(chat_id: int, message: dict):
@@ -280,15 +359,11 @@ async def broadcast_message(chat_id: int, message: dict):
     for participant in participants:
         user_id = participant[0]
         if user_id in active_connections:
-            try:
-                await active_connections[user_id].send_json({
-                    "type": "message",
-                    "message": {
-                        **message,
-                        "sender_name": message.get("sender_name", "Unknown User")
-                    }
-                })
-            except Exception as e:
-                print(f"Error sending message to user {user_id}: {e}")
-                if user_id in active_connections:
-                    del active_connections[user_id]
+            if not await send_or_drop(active_connections[user_id], {
+                "type": "message",
+                "message": {
+                    **message,
+                    "sender_name": message.get("sender_name", "Unknown User")
+                }
+            }):
+                logger.warning("Error sending message to user %s", user_id)
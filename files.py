@@ -1,6 +1,8 @@
 import os
 import shutil
-from fastapi import APIRouter, UploadFile, File
+from fastapi import APIRouter, UploadFile, File, Depends
+from auth import get_current_user
+from ratelimit import upload_limiter, upload_slots, rate_limit, concurrency_limit
 
 router = APIRouter()
 
@@ -10,8 +12,11 @@ if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 
 
-@router.post("/upload")
-def upload_file(file: UploadFile = File(...)):
+@router.post("/upload", dependencies=[
+    Depends(concurrency_limit(upload_slots)),
+    Depends(rate_limit(upload_limiter)),
+])
+def upload_file(file: UploadFile = File(...), current_user: int = Depends(get_current_user)):
     file_path = os.path.join(UPLOAD_DIR, file.filename)
 
     with open(file_path, "wb") as buffer:
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional
+from fastapi import WebSocket
+from logs import get_logger
+from ratelimit import connection_limiter
+
+logger = get_logger(__name__)
+
+# Интервал, с которым сервер рассылает ping всем подключениям (секунды)
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 25))
+# Если от клиента нет ни pong, ни сообщений дольше этого времени — соединение полуоткрыто
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", 60))
+# Закрываем сессии, по которым давно не было настоящих сообщений (0 — не закрывать)
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", 3600))
+# Сколько ждем отправки ping/close, прежде чем считать сокет мертвым
+SEND_TIMEOUT = float(os.getenv("HEARTBEAT_SEND_TIMEOUT", 5))
+
+# id(websocket) -> [websocket, реестр, user_id, последний кадр, последнее сообщение]
+# WebSocket не хешируется, поэтому ключом служит id()
+sessions: Dict[int, list] = {}
+
+_reaper_task: Optional[asyncio.Task] = None
+
+
+def register(registry: Dict[int, WebSocket], user_id: int, websocket: WebSocket):
+    now = time.monotonic()
+    registry[user_id] = websocket
+    sessions[id(websocket)] = [websocket, registry, user_id, now, now]
+
+
+def touch(websocket: WebSocket, active: bool = True):
+    # Любой кадр от клиента (включая pong) подтверждает, что соединение живо
+    session = sessions.get(id(websocket))
+    if session is not None:
+        now = time.monotonic()
+        session[3] = now
+        if active:
+            session[4] = now
+
+
+def unregister(websocket: WebSocket):
+    session = sessions.pop(id(websocket), None)
+    if session is None:
+        return
+    _, registry, user_id, _, _ = session
+    # Корзина лимитера привязана к подключению и после него не нужна
+    connection_limiter.discard(id(websocket))
+    # Пользователь мог переподключиться — не удаляем его новое соединение
+    if registry.get(user_id) is websocket:
+        del registry[user_id]
+
+
+async def send_or_drop(websocket: WebSocket, payload: dict) -> bool:
+    try:
+        await asyncio.wait_for(websocket.send_json(payload), SEND_TIMEOUT)
+        return True
+    except Exception:
+        # Клиент, не успевающий принимать, отключаем: без рассылки он бы
+        # молча отстал, а прерванная по таймауту отправка могла оборвать кадр
+        await close_session(websocket, code=1011)
+        return False
+
+
+async def close_session(websocket: WebSocket, code: int = 1001):
+    unregister(websocket)
+    try:
+        await asyncio.wait_for(websocket.close(code=code), SEND_TIMEOUT)
+    except Exception:
+        pass
+
+
+async def reap_once(now: Optional[float] = None) -> int:
+    if now is None:
+        now = time.monotonic()
+
+    stale: List[WebSocket] = []
+    alive: List[WebSocket] = []
+    for websocket, _, _, last_seen, last_active in list(sessions.values()):
+        if now - last_seen > HEARTBEAT_TIMEOUT:
+            stale.append(websocket)
+        elif IDLE_TIMEOUT and now - last_active > IDLE_TIMEOUT:
+            stale.append(websocket)
+        else:
+            alive.append(websocket)
+
+    # Закрываем мертвые и простаивающие сессии, живым отправляем ping
+    await asyncio.gather(
+        *(close_session(websocket) for websocket in stale),
+        *(send_or_drop(websocket, {"type": "ping"}) for websocket in alive),
+    )
+    return len(stale)
+
+
+async def heartbeat_loop():
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        try:
+            reaped = await reap_once()
+            if reaped:
+                logger.info("Closed %d stale WebSocket sessions", reaped)
+        except Exception:
+            logger.exception("Heartbeat error")
+
+
+def start_heartbeat():
+    global _reaper_task
+    if _reaper_task is None or _reaper_task.done():
+        _reaper_task = asyncio.get_running_loop().create_task(heartbeat_loop())
+
+
+async def stop_heartbeat():
+    global _reaper_task
+    if _reaper_task is not None:
+        _reaper_task.cancel()
+        try:
+            await _reaper_task
+        except asyncio.CancelledError:
+            pass
+        _reaper_task = None
@@ -0,0 +1,87 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from typing import Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Доля записей, которые проходят для частых событий с extra=SAMPLED
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+# Размер очереди; при переполнении записи отбрасываются, а не блокируют event loop
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+# extra для высокочастотных событий: logger.debug("...", extra=SAMPLED)
+SAMPLED = {"sample_rate": LOG_SAMPLE_RATE}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# Стандартные атрибуты LogRecord, которые не нужно дублировать в JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample_rate"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        # Поля, переданные через extra=
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample_rate", None)
+        return rate is None or random.random() < rate
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # В отличие от стандартного QueueHandler не форматирует запись в вызывающем
+    # потоке: getMessage() и JSON выполняются в фоновом потоке слушателя
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    handler = LazyQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        # Дописывает все, что осталось в очереди
+        _listener.stop()
+        _listener = None
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
@@ -5,7 +5,17 @@ from auth import router as auth_router
 from chat import router as chat_router
 from message import router as message_router
 from files import router as files_router
+from bootstrap import router as bootstrap_router
+from profiling import router as profiling_router
+from profiling import RequestProfilerMiddleware, LOOP_LAG_THRESHOLD, start_loop_lag_monitor, stop_loop_lag_monitor
+from heartbeat import start_heartbeat, stop_heartbeat
+from auth import check_secret_key, shutdown_hash_pool
+from ratelimit import start_eviction, stop_eviction
+from shards import close_shards
 from fastapi.staticfiles import StaticFiles
+from logs import setup_logging, stop_logging
+
+setup_logging()
 
 app = FastAPI()
 
@@ -19,6 +29,7 @@ app.add_middleware(
     expose_headers=["*"],
     max_age=3600,
 )
+app.add_middleware(RequestProfilerMiddleware)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -27,6 +38,26 @@ app.include_router(files_router, prefix="/files")
 app.include_router(auth_router, prefix="/auth")
 app.include_router(chat_router, prefix="/chats")
 app.include_router(message_router, prefix="/messages")
+app.include_router(bootstrap_router, prefix="/bootstrap")
+app.include_router(profiling_router, prefix="/admin/profiling")
+
+# Фоновые задачи: heartbeat WebSocket-сессий и очистка корзин rate limit
+@app.on_event("startup")
+async def on_startup():
+    check_secret_key()
+    start_heartbeat()
+    start_eviction()
+    if LOOP_LAG_THRESHOLD > 0:
+        start_loop_lag_monitor(LOOP_LAG_THRESHOLD)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await stop_heartbeat()
+    await stop_eviction()
+    stop_loop_lag_monitor()
+    close_shards()
+    stop_logging()
+    shutdown_hash_pool()
 
 @app.get("/")
 def root():
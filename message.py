@@ -1,12 +1,24 @@
 import sqlite3
-from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, Query
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 import json
 from datetime import datetime
-from chat import broadcast_message
+from chat import broadcast_message, is_chat_participant, get_chat_participants
+from auth import get_current_user, get_admin_user, ensure_same_user, authenticate_websocket
+from ratelimit import (
+    message_limiter, connection_limiter, messages_slots,
+    rate_limit, concurrency_limit,
+)
+from logs import get_logger
+from responses import FastJSONResponse
+from message_cache import recent_messages, RING_SIZE
+from heartbeat import register, touch, unregister, send_or_drop, close_session
+import shards
+from shards import setup_shards
 
 router = APIRouter()
+logger = get_logger(__name__)
 
 DATABASE = "chats.db"
 USERS_DATABASE = "users.db"  # База данных с пользователями
@@ -35,90 +47,109 @@ def get_user_name(user_id: int) -> str:
         result = cursor.fetchone()
         conn.close()
         return result[0] if result else "Unknown User"
-    except Exception as e:
-        print(f"Error getting username: {e}")
+    except Exception:
+        logger.exception("Error getting username for user %s", user_id)
         return "Unknown User"
 
-def setup_database():
-    with sqlite3.connect(DATABASE) as conn:
-        # Создаем временную таблицу с правильной структурой
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS messages_new (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            content TEXT NOT NULL,
-            sender_id INTEGER NOT NULL,
-            chat_id INTEGER NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (chat_id) REFERENCES chats (id)
-        )
-        """)
-
-        # Проверяем существование старой таблицы
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'")
-        if cursor.fetchone():
-            # Копируем данные из старой таблицы в новую
-            try:
-                conn.execute("""
-                INSERT INTO messages_new (id, content, sender_id, chat_id, created_at)
-                SELECT id, content, sender_id, chat_id, COALESCE(created_at, CURRENT_TIMESTAMP)
-                FROM messages
-                """)
-                # Удаляем старую таблицу
-                conn.execute("DROP TABLE messages")
-            except sqlite3.OperationalError:
-                # Если что-то пошло не так, просто создаем новую таблицу
-                conn.execute("DROP TABLE IF EXISTS messages")
-
-        # Переименовываем новую таблицу
-        conn.execute("ALTER TABLE messages_new RENAME TO messages")
-
-setup_database()
+# Сообщения хранятся в шардах, см. shards.py
+setup_shards()
+
+def ensure_chat_participant(chat_id: int, user_id: int):
+    if not is_chat_participant(chat_id, user_id):
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+# Рассылка по подключениям участников чата
+async def send_to_chat(chat_id: int, payload: dict):
+    for user_id in get_chat_participants(chat_id):
+        connection = connections.get(user_id)
+        if connection is not None:
+            await send_or_drop(connection, payload)
 
 # WebSocket подключение
 @router.websocket("/ws/{user_id}")
 async def websocket_chat(websocket: WebSocket, user_id: int):
+    if not await authenticate_websocket(websocket, user_id):
+        return
+
     await websocket.accept()
-    connections[user_id] = websocket
+    register(connections, user_id, websocket)
+    sender_name = get_user_name(user_id)
 
     try:
         while True:
             # Ожидаем сообщение от клиента
             message = await websocket.receive_json()
 
-            # Сохраняем сообщение в БД
-            with sqlite3.connect(DATABASE) as conn:
-                cursor = conn.cursor()
-                now = datetime.now().isoformat()
-
-                cursor.execute(
-                    """INSERT INTO messages (chat_id, sender_id, content, created_at) 
-                    VALUES (?, ?, ?, ?)""",
-                    (message["chat_id"], user_id, message["content"], now)
-                )
-
-                msg_id = cursor.lastrowid
-
-                # Отправляем сообщение всем подключенным пользователям
-                new_message = {
-                    "id": msg_id,
-                    "chat_id": message["chat_id"],
-                    "sender_id": user_id,
-                    "content": message["content"],
-                    "created_at": now
-                }
+            # Флуд в одном подключении — закрываем его. Учитываются все кадры, включая pong
+            if not connection_limiter.allow(id(websocket)):
+                await close_session(websocket, code=1008)
+                break
+
+            if message.get("type") == "pong":
+                # Ответ на heartbeat — соединение живо, но не активно
+                touch(websocket, active=False)
+                continue
+            touch(websocket)
+
+            # Превышен лимит сообщений пользователя — сообщение отбрасываем
+            if not message_limiter.allow(user_id):
+                await send_or_drop(websocket, {
+                    "type": "error",
+                    "detail": "Слишком много сообщений",
+                    "retry_after": message_limiter.retry_after(user_id)
+                })
+                continue
+
+            # Писать можно только в свои чаты
+            if not is_chat_participant(message["chat_id"], user_id):
+                await send_or_drop(websocket, {
+                    "type": "error",
+                    "detail": "Доступ запрещен",
+                    "chat_id": message["chat_id"]
+                })
+                continue
+
+            # Сохраняем сообщение в шард чата
+            now = datetime.now().isoformat()
+            msg_id, _, _, _, _ = await shards.insert_message(
+                message["chat_id"], user_id, message["content"], now
+            )
+
+            # В кеш — до первого await рассылки
+            recent_messages.append({
+                "id": msg_id,
+                "content": message["content"],
+                "sender_id": user_id,
+                "chat_id": message["chat_id"],
+                "created_at": now,
+                "sender_name": sender_name
+            })
+
+            # Отправляем сообщение подключенным участникам чата
+            new_message = {
+                "id": msg_id,
+                "chat_id": message["chat_id"],
+                "sender_id": user_id,
+                "content": message["content"],
+                "created_at": now
+            }
 
-                for connection in connections.values():
-                    await connection.send_json(new_message)
+            await send_to_chat(message["chat_id"], new_message)
 
-    except WebSocketDisconnect:
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
         # Удаляем соединение при отключении
-        if user_id in connections:
-            del connections[user_id]
+        unregister(websocket)
 
 # HTTP эндпоинты
-@router.post("/", response_model=MessageResponse)
-async def create_message(message: MessageCreate):
+@router.post("/", response_model=MessageResponse, dependencies=[
+    Depends(concurrency_limit(messages_slots)),
+    Depends(rate_limit(message_limiter)),
+])
+async def create_message(message: MessageCreate, current_user: int = Depends(get_current_user)):
+    ensure_same_user(current_user, message.sender_id)
+
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
@@ -127,24 +158,13 @@ async def create_message(message: MessageCreate):
         cursor.execute("SELECT id FROM chats WHERE id = ?", (message.chat_id,))
         if not cursor.fetchone():
             raise HTTPException(status_code=404, detail="Чат не найден")
+        ensure_chat_participant(message.chat_id, current_user)
 
         # Получаем имя отправителя из базы данных пользователей
         sender_name = get_user_name(message.sender_id)
 
-        # Создаем сообщение
-        cursor.execute(
-            "INSERT INTO messages (content, sender_id, chat_id) VALUES (?, ?, ?)",
-            (message.content, message.sender_id, message.chat_id)
-        )
-        message_id = cursor.lastrowid
-
-        # Получаем созданное сообщение
-        cursor.execute(
-            "SELECT * FROM messages WHERE id = ?",
-            (message_id,)
-        )
-        message_data = cursor.fetchone()
-        conn.commit()
+        # Создаем сообщение в шарде чата и получаем его обратно
+        message_data = await shards.insert_message(message.chat_id, message.sender_id, message.content)
 
         # Формируем ответ
         response = {
@@ -156,6 +176,8 @@ async def create_message(message: MessageCreate):
             "sender_name": sender_name
         }
 
+        recent_messages.append(response)
+
         # Отправляем сообщение через WebSocket
         await broadcast_message(message.chat_id, response)
 
@@ -163,94 +185,101 @@ async def create_message(message: MessageCreate):
     finally:
         conn.close()
 
-@router.get("/", response_model=List[MessageResponse])
-async def get_messages(chat_id: int):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+@router.get("/", response_model=List[MessageResponse], dependencies=[Depends(concurrency_limit(messages_slots))])
+async def get_messages(
+    chat_id: int,
+    limit: Optional[int] = Query(None, ge=1),  # только последние limit сообщений
+    current_user: int = Depends(get_current_user),
+):
+    ensure_chat_participant(chat_id, current_user)
+
+    # Последняя страница горячего чата отдается из кеша без обращения к БД
+    if limit is not None:
+        cached = recent_messages.get(chat_id, limit)
+        if cached is not None:
+            return FastJSONResponse(cached)
+
+    if limit is None:
+        return FastJSONResponse(render_messages(shards.fetch_messages(chat_id)))
+
+    # Читаем не меньше RING_SIZE сообщений, чтобы заполнить кеш чата целиком
+    messages = render_messages(shards.fetch_messages(chat_id, max(limit, RING_SIZE)))
+    recent_messages.fill(chat_id, messages)
+    return FastJSONResponse(messages[-limit:])
+
+# Строки уже соответствуют MessageResponse, повторная валидация не нужна
+def render_messages(rows) -> List[dict]:
+    return [
+        {
+            "id": msg_id,
+            "content": content,
+        "sender_id": sender_id,
+        "chat_id": chat_id,
+            "created_at": created_at,
+            "sender_name": sender_name
+        }
+        for msg_id, content, sender_id, chat_id, created_at, sender_name in rows
+    ]
 
-    try:
-        cursor.execute("""
-            SELECT m.* FROM messages m
-            WHERE m.chat_id = ?
-            ORDER BY m.created_at ASC
-        """, (chat_id,))
-        messages = cursor.fetchall()
-
-        return [
-            {
-                "id": msg[0],
-                "content": msg[1],
-                "sender_id": msg[2],
-                "chat_id": msg[3],
-                "created_at": msg[4],
-                "sender_name": get_user_name(msg[2])
-            }
-            for msg in messages
-        ]
-    finally:
-        conn.close()
+@router.get("/cache/stats", dependencies=[Depends(get_admin_user)])
+async def get_cache_stats():
+    return recent_messages.stats()
 
 @router.put("/edit")
-async def edit_message(message_id: int, new_content: str):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-
+async def edit_message(message_id: int, new_content: str, current_user: int = Depends(get_current_user)):
     # Получаем информацию о сообщении
-    cursor.execute("SELECT chat_id, sender_id FROM messages WHERE id = ?", (message_id,))
-    message_info = cursor.fetchone()
+    message_info = shards.find_message(message_id)
 
     if not message_info:
         raise HTTPException(status_code=404, detail="Сообщение не найдено")
 
     chat_id, sender_id = message_info
+    # Изменять и удалять сообщение может только его автор, пока состоит в чате
+    ensure_same_user(current_user, sender_id)
+    ensure_chat_participant(chat_id, current_user)
 
     # Обновляем сообщение
-    cursor.execute(
-        "UPDATE messages SET content = ?, created_at = ? WHERE id = ?",
-        (new_content, datetime.now().isoformat(), message_id)
-    )
-    conn.commit()
-    conn.close()
+    edited_at = datetime.now().isoformat()
+    await shards.update_message(chat_id, message_id, new_content, edited_at)
+
+    recent_messages.update(chat_id, message_id, content=new_content, created_at=edited_at)
 
     # Отправляем обновленное сообщение через WebSocket
-    for user_id, connection in connections.items():
-        await connection.send_json({
-            "type": "message_edit",
-            "id": message_id,
-            "chat_id": chat_id,
-            "sender_id": sender_id,
-            "content": new_content,
-            "created_at": datetime.now().isoformat()
-        })
+    await send_to_chat(chat_id, {
+        "type": "message_edit",
+        "id": message_id,
+        "chat_id": chat_id,
+        "sender_id": sender_id,
+        "content": new_content,
+        "created_at": edited_at
+    })
 
     return {"message": "Сообщение изменено"}
 
 @router.delete("/delete")
-async def delete_message(message_id: int):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-
+async def delete_message(message_id: int, current_user: int = Depends(get_current_user)):
     # Получаем информацию о сообщении
-    cursor.execute("SELECT chat_id, sender_id FROM messages WHERE id = ?", (message_id,))
-    message_info = cursor.fetchone()
+    message_info = shards.find_message(message_id)
 
     if not message_info:
         raise HTTPException(status_code=404, detail="Сообщение не найдено")
 
     chat_id, sender_id = message_info
+    # Изменять и удалять сообщение может только его автор, пока состоит в чате
+    ensure_same_user(current_user, sender_id)
+    ensure_chat_participant(chat_id, current_user)
 
     # Удаляем сообщение
-    cursor.execute("DELETE FROM messages WHERE id = ?", (message_id,))
-    conn.commit()
-    conn.close()
+    await shards.delete_message(chat_id, message_id)
+
+    recent_messages.remove(chat_id, message_id)
 
     # Отправляем уведомление об удалении через WebSocket
-    for user_id, connection in connections.items():
-        await connection.send_json({
-            "type": "message_delete",
-            "id": message_id,
-            "chat_id": chat_id,
-            "sender_id": sender_id
-        })
+    await send_to_chat(chat_id, {
+        "type": "message_delete",
+        "id": message_id,
+        "chat_id": chat_id,
+        "sender_id": sender_id
+    })
 
     return {"message": "Сообщение удалено"}
\ No newline at end of file
@@ -0,0 +1,116 @@
+import os
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+# Сколько последних сообщений хранится для одного чата
+RING_SIZE = int(os.getenv("MESSAGE_CACHE_RING_SIZE", 50))
+# Общий лимит сообщений в кеше; при превышении вытесняются самые холодные чаты
+MAX_CACHED_MESSAGES = int(os.getenv("MESSAGE_CACHE_MAX_MESSAGES", 100_000))
+
+# Последние сообщения одного чата в порядке id
+class ChatRing:
+    __slots__ = ("messages", "full_history")
+
+    def __init__(self, messages: List[dict], full_history: bool):
+        self.messages = deque(messages, maxlen=RING_SIZE)
+        # True, если в кольце вся история чата, а не только ее хвост
+        self.full_history = full_history
+
+# Кеш готовых к отдаче сообщений для горячих чатов. Заполняется при промахе
+# чтения и поддерживается записью, изменением и удалением сообщений
+class RecentMessagesCache:
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self.rings: "OrderedDict[int, ChatRing]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, chat_id: int, limit: int) -> Optional[List[dict]]:
+        ring = self.rings.get(chat_id)
+        if ring is None or (limit > len(ring.messages) and not ring.full_history):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.rings.move_to_end(chat_id)
+        messages = ring.messages
+        if limit >= len(messages):
+            return list(messages)
+        return list(messages)[-limit:]
+
+    def fill(self, chat_id: int, messages: List[dict]):
+        # messages — последние RING_SIZE сообщений чата из БД в порядке id
+        self._drop(chat_id)
+        self.rings[chat_id] = ChatRing(messages[-RING_SIZE:], len(messages) < RING_SIZE)
+        self.size += len(self.rings[chat_id].messages)
+        self._evict()
+
+    def append(self, message: dict):
+        # Незакешированный чат не заводим: в кольце оказался бы неполный хвост
+        ring = self.rings.get(message["chat_id"])
+        if ring is None:
+            return
+        # Пока запись ждала шард, кольцо могли заполнить из БД уже с этим
+        # сообщением, а соседние записи — завершиться в другом порядке
+        messages = ring.messages
+        position = len(messages)
+        while position and messages[position - 1]["id"] >= message["id"]:
+            if messages[position - 1]["id"] == message["id"]:
+                return
+            position -= 1
+        if len(messages) == RING_SIZE:
+            ring.full_history = False
+            if position == 0:
+                return
+            messages.popleft()
+            position -= 1
+        else:
+            self.size += 1
+        messages.insert(position, message)
+        self.rings.move_to_end(message["chat_id"])
+        self._evict()
+
+    def update(self, chat_id: int, message_id: int, **fields):
+        ring = self.rings.get(chat_id)
+        if ring is None:
+            return
+        for index, message in enumerate(ring.messages):
+            if message["id"] == message_id:
+                ring.messages[index] = {**message, **fields}
+                return
+
+    def remove(self, chat_id: int, message_id: int):
+        ring = self.rings.get(chat_id)
+        if ring is None:
+            return
+        for message in ring.messages:
+            if message["id"] == message_id:
+                ring.messages.remove(message)
+                self.size -= 1
+                return
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "chats": len(self.rings),
+            "messages": self.size,
+            "max_messages": self.max_messages,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def _drop(self, chat_id: int):
+        ring = self.rings.pop(chat_id, None)
+        if ring is not None:
+            self.size -= len(ring.messages)
+
+    def _evict(self):
+        while self.size > self.max_messages and self.rings:
+            _, ring = self.rings.popitem(last=False)
+            self.size -= len(ring.messages)
+            self.evictions += 1
+
+recent_messages = RecentMessagesCache(MAX_CACHED_MESSAGES)
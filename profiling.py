@@ -0,0 +1,284 @@
+import asyncio
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import Response
+from pydantic import BaseModel
+from auth import get_admin_user
+from logs import get_logger
+
+router = APIRouter(dependencies=[Depends(get_admin_user)])
+logger = get_logger(__name__)
+
+# Порог блокировки event loop, при котором логируется стек (0 — монитор выключен)
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", 0))
+# Ограничения на сеанс семплирования
+MAX_SAMPLING_DURATION = 600
+MIN_SAMPLING_INTERVAL = 0.001
+
+class SamplingStart(BaseModel):
+    duration: float = 30
+    interval: float = 0.005
+
+class RequestProfilingStart(BaseModel):
+    route_prefix: Optional[str] = None  # профилировать запросы с этим префиксом пути
+    header: bool = False  # профилировать запросы с заголовком X-Profile: 1
+    max_requests: int = 100
+
+class LoopLagStart(BaseModel):
+    threshold: float = 0.1
+
+# Семплирующий профайлер: фоновый поток снимает стек потока event loop
+sampling = {
+    "thread": None,
+    "stop": threading.Event(),
+    "stacks": Counter(),
+    "samples": 0,
+    "started_at": None,
+    "finished_at": None,
+}
+
+# Профилирование отдельных запросов через cProfile
+request_profiling = {
+    "enabled": False,
+    "route_prefix": None,
+    "header": False,
+    "remaining": 0,
+    "active": False,  # cProfile не может профилировать два запроса одновременно
+    "stats": None,
+    "requests": 0,
+}
+
+# Монитор задержек event loop
+loop_lag = {
+    "task": None,
+    "thread": None,
+    "stop": threading.Event(),
+    "threshold": 0.0,
+    "last_tick": 0.0,
+    "blocked_events": 0,
+}
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+def _collapse(frame) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+def _sample_loop(thread_id: int, deadline: float, interval: float):
+    stop = sampling["stop"]
+    while not stop.is_set() and time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            sampling["stacks"][_collapse(frame)] += 1
+            sampling["samples"] += 1
+        stop.wait(interval)
+    sampling["finished_at"] = time.time()
+
+def start_sampling(duration: float, interval: float):
+    if sampling["thread"] is not None and sampling["thread"].is_alive():
+        raise HTTPException(status_code=409, detail="Семплирование уже запущено")
+
+    sampling["stop"] = threading.Event()
+    sampling["stacks"] = Counter()
+    sampling["samples"] = 0
+    sampling["started_at"] = time.time()
+    sampling["finished_at"] = None
+    # Вызывается из обработчика, то есть в потоке event loop
+    thread = threading.Thread(
+        target=_sample_loop,
+        args=(threading.get_ident(), time.monotonic() + duration, interval),
+        name="sampling-profiler",
+        daemon=True,
+    )
+    sampling["thread"] = thread
+    thread.start()
+
+def collapsed_stacks() -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in sampling["stacks"].most_common())
+
+def _matches_request(scope) -> bool:
+    if request_profiling["route_prefix"] and scope["path"].startswith(request_profiling["route_prefix"]):
+        return True
+    if request_profiling["header"]:
+        for name, value in scope["headers"]:
+            if name == b"x-profile" and value == b"1":
+                return True
+    return False
+
+# ASGI-middleware: без включенного профилирования стоит одну проверку флага.
+# Профиль запроса включает и другие корутины, выполнявшиеся в это время в event loop
+class RequestProfilerMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not request_profiling["enabled"]
+            or request_profiling["active"]
+            or not _matches_request(scope)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        request_profiling["active"] = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.disable()
+            request_profiling["active"] = False
+            if request_profiling["stats"] is None:
+                request_profiling["stats"] = pstats.Stats(profiler)
+            else:
+                request_profiling["stats"].add(profiler)
+            request_profiling["requests"] += 1
+            request_profiling["remaining"] -= 1
+            if request_profiling["remaining"] <= 0:
+                request_profiling["enabled"] = False
+
+def _watch_loop(thread_id: int):
+    stop = loop_lag["stop"]
+    reported_tick = None
+    while not stop.wait(loop_lag["threshold"] / 2):
+        last_tick = loop_lag["last_tick"]
+        lag = time.monotonic() - last_tick
+        # Об одной и той же блокировке сообщаем один раз
+        if lag > loop_lag["threshold"] and reported_tick != last_tick:
+            reported_tick = last_tick
+            loop_lag["blocked_events"] += 1
+            frame = sys._current_frames().get(thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            logger.warning("Event loop blocked for at least %.3fs", lag, extra={"stack": stack})
+
+async def _tick_loop():
+    while True:
+        loop_lag["last_tick"] = time.monotonic()
+        await asyncio.sleep(loop_lag["threshold"] / 4)
+
+def start_loop_lag_monitor(threshold: float):
+    stop_loop_lag_monitor()
+    loop_lag["threshold"] = threshold
+    loop_lag["last_tick"] = time.monotonic()
+    loop_lag["stop"] = threading.Event()
+    loop_lag["task"] = asyncio.get_running_loop().create_task(_tick_loop())
+    thread = threading.Thread(
+        target=_watch_loop,
+        args=(threading.get_ident(),),
+        name="loop-lag-monitor",
+        daemon=True,
+    )
+    loop_lag["thread"] = thread
+    thread.start()
+
+def stop_loop_lag_monitor():
+    loop_lag["stop"].set()
+    if loop_lag["task"] is not None:
+        loop_lag["task"].cancel()
+        loop_lag["task"] = None
+    loop_lag["thread"] = None
+
+@router.get("/status")
+async def profiling_status():
+    return {
+        "sampling": {
+            "running": sampling["thread"] is not None and sampling["thread"].is_alive(),
+            "samples": sampling["samples"],
+            "started_at": sampling["started_at"],
+            "finished_at": sampling["finished_at"],
+        },
+        "requests": {
+            "enabled": request_profiling["enabled"],
+            "route_prefix": request_profiling["route_prefix"],
+            "header": request_profiling["header"],
+            "remaining": request_profiling["remaining"],
+            "profiled": request_profiling["requests"],
+        },
+        "loop_lag": {
+            "running": loop_lag["task"] is not None,
+            "threshold": loop_lag["threshold"],
+            "blocked_events": loop_lag["blocked_events"],
+        },
+    }
+
+@router.post("/sampling/start")
+async def sampling_start(options: SamplingStart):
+    if not 0 < options.duration <= MAX_SAMPLING_DURATION or options.interval < MIN_SAMPLING_INTERVAL:
+        raise HTTPException(status_code=400, detail="Недопустимые параметры семплирования")
+    start_sampling(options.duration, options.interval)
+    return {"message": "Семплирование запущено"}
+
+@router.post("/sampling/stop")
+async def sampling_stop():
+    sampling["stop"].set()
+    return {"message": "Семплирование остановлено"}
+
+# Формат collapsed stacks для flamegraph.pl / speedscope
+@router.get("/sampling/download")
+async def sampling_download():
+    return Response(
+        collapsed_stacks(),
+        media_type="text/plain",
+        headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'},
+    )
+
+@router.post("/requests/start")
+async def requests_start(options: RequestProfilingStart):
+    if not options.route_prefix and not options.header:
+        raise HTTPException(status_code=400, detail="Укажите route_prefix или header")
+    request_profiling.update(
+        enabled=True,
+        route_prefix=options.route_prefix,
+        header=options.header,
+        remaining=options.max_requests,
+        stats=None,
+        requests=0,
+    )
+    return {"message": "Профилирование запросов включено"}
+
+@router.post("/requests/stop")
+async def requests_stop():
+    request_profiling["enabled"] = False
+    return {"message": "Профилирование запросов выключено"}
+
+# Файл для pstats.Stats / snakeviz
+@router.get("/requests/download")
+async def requests_download():
+    stats = request_profiling["stats"]
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Профиль пуст")
+    buffer = io.BytesIO()
+    marshal.dump(stats.stats, buffer)
+    return Response(
+        buffer.getvalue(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="requests.pstats"'},
+    )
+
+@router.post("/loop-lag/start")
+async def loop_lag_start(options: LoopLagStart):
+    if options.threshold <= 0:
+        raise HTTPException(status_code=400, detail="Порог должен быть больше нуля")
+    start_loop_lag_monitor(options.threshold)
+    return {"message": "Монитор event loop запущен"}
+
+@router.post("/loop-lag/stop")
+async def loop_lag_stop():
+    stop_loop_lag_monitor()
+    return {"message": "Монитор event loop остановлен"}
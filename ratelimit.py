@@ -0,0 +1,138 @@
+import asyncio
+import math
+import os
+import time
+from typing import Dict, Hashable, List, Optional
+from fastapi import HTTPException, Depends
+from auth import get_current_user
+
+# Сообщения от одного пользователя (HTTP и WebSocket вместе)
+MESSAGE_RATE = float(os.getenv("MESSAGE_RATE", 5))
+MESSAGE_BURST = float(os.getenv("MESSAGE_BURST", 20))
+# Любые кадры в рамках одного WebSocket-подключения
+CONNECTION_RATE = float(os.getenv("CONNECTION_RATE", 10))
+CONNECTION_BURST = float(os.getenv("CONNECTION_BURST", 40))
+# Загрузка файлов одним пользователем
+UPLOAD_RATE = float(os.getenv("UPLOAD_RATE", 0.2))
+UPLOAD_BURST = float(os.getenv("UPLOAD_BURST", 5))
+
+# Одновременно выполняемые тяжелые запросы на весь процесс
+CHATS_LIST_CONCURRENCY = int(os.getenv("CHATS_LIST_CONCURRENCY", 32))
+MESSAGES_CONCURRENCY = int(os.getenv("MESSAGES_CONCURRENCY", 64))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 8))
+
+# Как часто удалять простаивающие корзины (секунды)
+EVICT_INTERVAL = float(os.getenv("RATE_LIMIT_EVICT_INTERVAL", 60))
+
+_limiters: List["RateLimiter"] = []
+_evict_task: Optional[asyncio.Task] = None
+
+# Token bucket на ключ: [оставшиеся токены, время последнего обращения]
+class RateLimiter:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        # Через это время корзина гарантированно полна и неотличима от новой
+        self.idle_ttl = burst / rate if rate > 0 else 0
+        self.buckets: Dict[Hashable, list] = {}
+        _limiters.append(self)
+
+    def allow(self, key: Hashable, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < cost:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - cost
+        return True
+
+    def retry_after(self, key: Hashable, cost: float = 1.0) -> int:
+        bucket = self.buckets.get(key)
+        if bucket is None or self.rate <= 0:
+            return 1
+        return max(1, math.ceil((cost - bucket[0]) / self.rate))
+
+    def discard(self, key: Hashable):
+        self.buckets.pop(key, None)
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.idle_ttl
+        idle = [key for key, bucket in self.buckets.items() if bucket[1] < cutoff]
+        for key in idle:
+            del self.buckets[key]
+        return len(idle)
+
+# Счетчик одновременных запросов без очереди: лишние сразу получают 429
+class ConcurrencyLimiter:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+
+    def try_acquire(self) -> bool:
+        if self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+message_limiter = RateLimiter(MESSAGE_RATE, MESSAGE_BURST)
+connection_limiter = RateLimiter(CONNECTION_RATE, CONNECTION_BURST)
+upload_limiter = RateLimiter(UPLOAD_RATE, UPLOAD_BURST)
+
+chats_list_slots = ConcurrencyLimiter(CHATS_LIST_CONCURRENCY)
+messages_slots = ConcurrencyLimiter(MESSAGES_CONCURRENCY)
+upload_slots = ConcurrencyLimiter(UPLOAD_CONCURRENCY)
+
+def too_many_requests(retry_after: int = 1) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Слишком много запросов",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+# Зависимость FastAPI: ограничение частоты запросов одного пользователя
+def rate_limit(limiter: RateLimiter):
+    async def dependency(current_user: int = Depends(get_current_user)):
+        if not limiter.allow(current_user):
+            raise too_many_requests(limiter.retry_after(current_user))
+    return dependency
+
+# Зависимость FastAPI: ограничение одновременных запросов к эндпоинту
+def concurrency_limit(limiter: ConcurrencyLimiter):
+    async def dependency():
+        if not limiter.try_acquire():
+            raise too_many_requests()
+        try:
+            yield
+        finally:
+            limiter.release()
+    return dependency
+
+async def evict_loop():
+    while True:
+        await asyncio.sleep(EVICT_INTERVAL)
+        for limiter in _limiters:
+            limiter.evict_idle()
+
+def start_eviction():
+    global _evict_task
+    if _evict_task is None or _evict_task.done():
+        _evict_task = asyncio.get_running_loop().create_task(evict_loop())
+
+async def stop_eviction():
+    global _evict_task
+    if _evict_task is not None:
+        _evict_task.cancel()
+        try:
+            await _evict_task
+        except asyncio.CancelledError:
+            pass
+        _evict_task = None
@@ -0,0 +1,111 @@
+import argparse
+import json
+import statistics
+import time
+from typing import Any, List
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него используем стандартный json
+    orjson = None
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# Ответ, который FastAPI отдает как есть: без повторной валидации через
+# response_model и без jsonable_encoder. Схема OpenAPI по-прежнему строится
+# из response_model эндпоинта, поэтому данные должны ему соответствовать
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+# Сравнение старого пути (response_model + jsonable_encoder) с FastJSONResponse
+# на списке сообщений того же вида, что отдает GET /messages/
+def _bench_app(rows: int):
+    from fastapi import FastAPI
+    from pydantic import BaseModel
+
+    # Те же поля, что у message.MessageResponse; импорт message создал бы базы
+    class Message(BaseModel):
+        id: int
+        content: str
+        sender_id: int
+        chat_id: int
+        created_at: str
+        sender_name: str
+
+    messages = [
+        {
+            "id": (1 << 40) + number,
+            "content": f"Сообщение номер {number}",
+            "sender_id": number % 50,
+            "chat_id": 1,
+            "created_at": f"2026-10-19T12:{number // 600 % 60:02d}:{number // 10 % 60:02d}.{number:06d}",
+            "sender_name": f"user{number % 50}",
+        }
+        for number in range(rows)
+    ]
+
+    app = FastAPI()
+
+    @app.get("/response_model", response_model=List[Message])
+    async def with_response_model():
+        return messages
+
+    @app.get("/fast", response_model=List[Message])
+    async def with_fast_response():
+        return FastJSONResponse(messages)
+
+    return app
+
+def _bench(rows: int, repeat: int) -> dict:
+    global orjson
+    from fastapi.testclient import TestClient
+
+    client = TestClient(_bench_app(rows))
+    installed = orjson
+    variants = [("response_model", "/response_model", installed), ("FastJSONResponse", "/fast", installed)]
+    if installed is not None:
+        variants.append(("FastJSONResponse, stdlib json", "/fast", None))
+
+    results = {}
+    reference = None
+    for name, path, serializer in variants:
+        orjson = serializer
+        try:
+            body = client.get(path).json()  # прогрев
+            # Все варианты должны отдавать одно и то же
+            if reference is None:
+                reference = body
+            assert body == reference, name
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                client.get(path)
+                timings.append(time.perf_counter() - started)
+        finally:
+            orjson = installed
+        results[name] = statistics.median(timings)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Сериализация JSON-ответов")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    bench_parser = commands.add_parser("bench", help="response_model против FastJSONResponse")
+    bench_parser.add_argument("--rows", type=int, default=10000)
+    bench_parser.add_argument("--repeat", type=int, default=20)
+
+    args = parser.parse_args()
+    results = _bench(args.rows, args.repeat)
+    baseline = results["response_model"]
+    for name, elapsed in results.items():
+        print(f"{name}: {elapsed * 1000:.1f} ms per {args.rows} rows ({baseline / elapsed:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+DATABASE = "chats.db"  # здесь хранятся чаты, участники и раскладка шардов
+USERS_DATABASE = "users.db"
+
+# Сообщения разложены по SHARD_COUNT файлам по хешу chat_id
+SHARD_COUNT = int(os.getenv("MESSAGE_SHARDS", 4))
+SHARD_FILE = os.getenv("MESSAGE_SHARD_FILE", "messages_shard_{}.db")
+# id сообщения = счетчик * MAX_SHARDS + номер шарда: младшие разряды не дают
+# шардам выдать одинаковый id, а счетчик растет и после переноса чатов, поэтому
+# id в пределах чата всегда возрастают. Число шардов не может быть больше
+MAX_SHARDS = 1024
+if not 0 < SHARD_COUNT <= MAX_SHARDS:
+    raise ValueError(f"MESSAGE_SHARDS должно быть от 1 до {MAX_SHARDS}")
+# PRAGMA synchronous для писателей. FULL дает fsync на каждый коммит, и
+# подтвержденное сообщение переживает отключение питания. NORMAL в режиме WAL
+# быстрее, но при сбое ОС может потерять последние подтвержденные сообщения
+SHARD_SYNCHRONOUS = os.getenv("MESSAGE_SHARD_SYNCHRONOUS", "FULL").upper()
+if SHARD_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"Недопустимое значение MESSAGE_SHARD_SYNCHRONOUS: {SHARD_SYNCHRONOUS}")
+# Сколько строк переносится за одну транзакцию при ребалансировке
+MOVE_BATCH = 1000
+
+MESSAGE_COLUMNS = "id, content, sender_id, chat_id, created_at"
+
+def shard_index(chat_id: int, count: int = SHARD_COUNT) -> int:
+    return zlib.crc32(str(chat_id).encode()) % count
+
+def shard_path(index: int) -> str:
+    return SHARD_FILE.format(index)
+
+# Один файл SQLite с сообщениями. Все записи идут через собственный поток
+# писателя с постоянным соединением, поэтому шарды коммитят параллельно
+class Shard:
+    def __init__(self, index: int, path: str):
+        self.index = index
+        self.path = path
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-writer-{index}")
+        self._write_conn: Optional[sqlite3.Connection] = None
+
+    def connect(self, with_users: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        if with_users:
+            conn.execute("ATTACH DATABASE ? AS users_db", (USERS_DATABASE,))
+        return conn
+
+    async def write(self, operation, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.writer, self._run_write, operation, args)
+
+    # Выполняется в потоке писателя
+    def _run_write(self, operation, args):
+        if self._write_conn is None:
+            self._write_conn = sqlite3.connect(self.path)
+            self._write_conn.execute(f"PRAGMA synchronous={SHARD_SYNCHRONOUS}")
+        try:
+            result = operation(self._write_conn, *args)
+            self._write_conn.commit()
+            return result
+        except Exception:
+            self._write_conn.rollback()
+            raise
+
+    def _close_writer(self):
+        if self._write_conn is not None:
+            self._write_conn.close()
+            self._write_conn = None
+
+    def close(self):
+        self.writer.submit(self._close_writer)
+        self.writer.shutdown(wait=True)
+
+shards: List[Shard] = [Shard(index, shard_path(index)) for index in range(SHARD_COUNT)]
+
+def shard_for(chat_id: int) -> Shard:
+    return shards[shard_index(chat_id)]
+
+def close_shards():
+    for shard in shards:
+        shard.close()
+
+def create_shard_schema(path: str):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT NOT NULL,
+                sender_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, id)")
+        conn.commit()
+    finally:
+        conn.close()
+
+def _has_messages_table(conn: sqlite3.Connection) -> bool:
+    cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'")
+    return cursor.fetchone() is not None
+
+# В старых версиях chats.db время сообщения хранилось в колонке timestamp
+def _created_at_column(conn: sqlite3.Connection) -> str:
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(messages)")]
+    for name in ("created_at", "timestamp"):
+        if name in columns:
+            return name
+    return "NULL"
+
+def _existing_shard_files() -> Dict[int, str]:
+    prefix, suffix = SHARD_FILE.split("{}")
+    pattern = re.compile(re.escape(prefix) + r"(\d+)" + re.escape(suffix) + "$")
+    files = {}
+    for path in glob.glob(glob.escape(prefix) + "*" + glob.escape(suffix)):
+        match = pattern.match(path)
+        if match:
+            files[int(match.group(1))] = path
+    return files
+
+# sqlite_sequence хранит наибольший id, когда-либо записанный в шард
+def _last_id(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT MAX(seq) FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+    return row[0] or 0
+
+def _raise_last_id(conn: sqlite3.Connection, last_id: int):
+    if conn.execute(
+        "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'", (last_id,)
+    ).rowcount == 0:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)", (last_id,))
+
+def _move_chat(source: sqlite3.Connection, target_path: str, chat_id: int) -> int:
+    # Сначала копия фиксируется в целевом шарде, потом удаляется из исходного;
+    # INSERT OR REPLACE делает повторный запуск после сбоя безопасным
+    moved = 0
+    created_at = _created_at_column(source)
+    target = sqlite3.connect(target_path)
+    try:
+        last_id = -1
+        while True:
+            rows = source.execute(
+                f"""SELECT id, content, sender_id, chat_id, {created_at} FROM messages
+                WHERE chat_id = ? AND id > ? ORDER BY id LIMIT ?""",
+                (chat_id, last_id, MOVE_BATCH)
+            ).fetchall()
+            if not rows:
+                break
+            target.executemany(
+                f"""INSERT OR REPLACE INTO messages ({MESSAGE_COLUMNS})
+                VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))""",
+                rows
+            )
+            target.commit()
+            moved += len(rows)
+            last_id = rows[-1][0]
+    finally:
+        target.close()
+    source.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+    source.commit()
+    return moved
+
+# Переносит каждый чат в шард, положенный ему при count шардах. Источники —
+# все существующие файлы шардов и старая таблица messages в chats.db.
+# Запускать при остановленном сервере
+def rebalance(count: int = SHARD_COUNT) -> int:
+    for index in range(count):
+        create_shard_schema(shard_path(index))
+
+    sources: List[Tuple[Optional[int], str]] = [(None, DATABASE)] + sorted(_existing_shard_files().items())
+    moved = 0
+    for source_index, path in sources:
+        source = sqlite3.connect(path)
+        try:
+            if not _has_messages_table(source):
+                continue
+            chat_ids = [row[0] for row in source.execute("SELECT DISTINCT chat_id FROM messages")]
+            for chat_id in chat_ids:
+                target_index = shard_index(chat_id, count)
+                if target_index != source_index:
+                    moved += _move_chat(source, shard_path(target_index), chat_id)
+            if source_index is None:
+                # Старая таблица из chats.db больше не нужна
+                source.execute("DROP TABLE messages")
+                source.execute("DROP TABLE IF EXISTS messages_new")
+                source.commit()
+            elif source_index >= count:
+                logger.info("Shard %s is empty and can be removed", path)
+        finally:
+            source.close()
+
+    # Новые id каждого шарда начинаются выше всех существующих, в том числе
+    # перенесенных из старой таблицы и из удаленных шардов
+    last_id = 0
+    for path in [shard_path(index) for index in range(count)] + list(_existing_shard_files().values()):
+        conn = sqlite3.connect(path)
+        try:
+            last_id = max(last_id, _last_id(conn))
+        finally:
+            conn.close()
+    for index in range(count):
+        conn = sqlite3.connect(shard_path(index))
+        try:
+            _raise_last_id(conn, last_id)
+            conn.commit()
+        finally:
+            conn.close()
+
+    conn = sqlite3.connect(DATABASE)
+    try:
+        _save_shard_count(conn, count)
+    finally:
+        conn.close()
+    logger.info("Rebalanced messages across %d shards, moved %d rows", count, moved)
+    return moved
+
+def _save_shard_count(conn: sqlite3.Connection, count: int):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_shards (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            count INTEGER NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR REPLACE INTO message_shards (id, count) VALUES (0, ?)", (count,))
+    conn.commit()
+
+# Вызывается при импорте: только создает схему. Данные переносит лишь
+# 'python shards.py rebalance' при остановленном сервере
+def setup_shards():
+    for shard in shards:
+        create_shard_schema(shard.path)
+
+    conn = sqlite3.connect(DATABASE)
+    try:
+        legacy = _has_messages_table(conn)
+        stored = None
+        if conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='message_shards'"
+        ).fetchone():
+            row = conn.execute("SELECT count FROM message_shards WHERE id = 0").fetchone()
+            stored = row[0] if row else None
+        if legacy:
+            raise RuntimeError(
+                f"В {DATABASE} осталась старая таблица messages: остановите сервер "
+                f"и выполните 'python shards.py rebalance --shards {SHARD_COUNT}'"
+            )
+        if stored is not None and stored != SHARD_COUNT:
+            raise RuntimeError(
+                f"Сообщения разложены по {stored} шардам, а MESSAGE_SHARDS={SHARD_COUNT}: "
+                f"укажите MESSAGE_SHARDS={stored} или остановите сервер и выполните "
+                f"'python shards.py rebalance --shards {SHARD_COUNT}'"
+            )
+        if stored is None:
+            _save_shard_count(conn, SHARD_COUNT)
+    finally:
+        conn.close()
+
+def _group_by_shard(chat_ids: Iterable[int]) -> Dict[int, List[int]]:
+    groups: Dict[int, List[int]] = {}
+    for chat_id in chat_ids:
+        groups.setdefault(shard_index(chat_id), []).append(chat_id)
+    return groups
+
+# Операции записи, выполняются в потоке писателя шарда, поэтому выдача id
+# без гонок. Вставка явного id сама поднимает sqlite_sequence
+def _insert(conn: sqlite3.Connection, index: int, chat_id: int, sender_id: int, content: str, created_at: Optional[str]):
+    msg_id = (_last_id(conn) // MAX_SHARDS + 1) * MAX_SHARDS + index
+    if created_at is None:
+        conn.execute(
+            "INSERT INTO messages (id, content, sender_id, chat_id) VALUES (?, ?, ?, ?)",
+            (msg_id, content, sender_id, chat_id)
+        )
+    else:
+        conn.execute(
+            "INSERT INTO messages (id, content, sender_id, chat_id, created_at) VALUES (?, ?, ?, ?, ?)",
+            (msg_id, content, sender_id, chat_id, created_at)
+        )
+    return conn.execute(
+        f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id = ?", (msg_id,)
+    ).fetchone()
+
+def _update(conn: sqlite3.Connection, message_id: int, content: str, created_at: str):
+    conn.execute(
+        "UPDATE messages SET content = ?, created_at = ? WHERE id = ?",
+        (content, created_at, message_id)
+    )
+
+def _delete(conn: sqlite3.Connection, message_id: int):
+    conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+
+async def insert_message(chat_id: int, sender_id: int, content: str, created_at: Optional[str] = None) -> tuple:
+    # (id, content, sender_id, chat_id, created_at)
+    shard = shard_for(chat_id)
+    return await shard.write(_insert, shard.index, chat_id, sender_id, content, created_at)
+
+async def update_message(chat_id: int, message_id: int, content: str, created_at: str):
+    await shard_for(chat_id).write(_update, message_id, content, created_at)
+
+async def delete_message(chat_id: int, message_id: int):
+    await shard_for(chat_id).write(_delete, message_id)
+
+# По id шард неизвестен, поэтому ищем во всех: это точечные запросы по ключу
+def find_message(message_id: int) -> Optional[Tuple[int, int]]:
+    for shard in shards:
+        conn = shard.connect()
+        try:
+            row = conn.execute(
+                "SELECT chat_id, sender_id FROM messages WHERE id = ?", (message_id,)
+            ).fetchone()
+        finally:
+            conn.close()
+        if row:
+            return row
+    return None
+
+# Сообщения чата с именами отправителей:
+# (id, content, sender_id, chat_id, created_at, sender_name)
+def fetch_messages(chat_id: int, limit: Optional[int] = None) -> List[tuple]:
+    conn = shard_for(chat_id).connect(with_users=True)
+    try:
+        if limit is None:
+            return conn.execute(f"""
+                SELECT m.id, m.content, m.sender_id, m.chat_id, m.created_at,
+                       COALESCE(u.login, 'Unknown User')
+                FROM messages m
+                LEFT JOIN users_db.users u ON u.id = m.sender_id
+                WHERE m.chat_id = ?
+                ORDER BY m.created_at ASC
+            """, (chat_id,)).fetchall()
+        rows = conn.execute(f"""
+            SELECT m.id, m.content, m.sender_id, m.chat_id, m.created_at,
+                   COALESCE(u.login, 'Unknown User')
+            FROM messages m
+            LEFT JOIN users_db.users u ON u.id = m.sender_id
+            WHERE m.chat_id = ?
+            ORDER BY m.id DESC
+            LIMIT ?
+        """, (chat_id, limit)).fetchall()
+        rows.reverse()
+        return rows
+    finally:
+        conn.close()
+
+# Последнее сообщение каждого чата: chat_id -> (id, content, sender_id, created_at)
+def last_messages(chat_ids: Iterable[int]) -> Dict[int, tuple]:
+    result = {}
+    for index, group in _group_by_shard(chat_ids).items():
+        conn = shards[index].connect()
+        try:
+            for chat_id, msg_id, content, sender_id, created_at in conn.execute("""
+                SELECT m.chat_id, m.id, m.content, m.sender_id, m.created_at
+                FROM messages m
+                JOIN (
+                    SELECT chat_id, MAX(id) AS last_id
+                    FROM messages
+                    WHERE chat_id IN (SELECT value FROM json_each(?))
+                    GROUP BY chat_id
+                ) last ON last.last_id = m.id
+            """, (json.dumps(group),)):
+                result[chat_id] = (msg_id, content, sender_id, created_at)
+        finally:
+            conn.close()
+    return result
+
+# Число непрочитанных: read_marks — chat_id -> id последнего прочитанного сообщения
+def unread_counts(read_marks: Dict[int, int], user_id: int) -> Dict[int, int]:
+    result = {}
+    for index, group in _group_by_shard(read_marks).items():
+        marks = json.dumps([[chat_id, read_marks[chat_id]] for chat_id in group])
+        conn = shards[index].connect()
+        try:
+            for chat_id, count in conn.execute("""
+                SELECT m.chat_id, COUNT(*)
+                FROM json_each(?) r
+                JOIN messages m
+                  ON m.chat_id = json_extract(r.value, '$[0]')
+                 AND m.id > json_extract(r.value, '$[1]')
+                WHERE m.sender_id != ?
+                GROUP BY m.chat_id
+            """, (marks, user_id)):
+                result[chat_id] = count
+        finally:
+            conn.close()
+    return result
+
+# Последние per_chat сообщений для каждого чата, по возрастанию id
+def recent_messages(chat_ids: Iterable[int], per_chat: int) -> Dict[int, List[tuple]]:
+    result: Dict[int, List[tuple]] = {}
+    for index, group in _group_by_shard(chat_ids).items():
+        conn = shards[index].connect(with_users=True)
+        try:
+            for row in conn.execute("""
+                SELECT r.id, r.content, r.sender_id, r.chat_id, r.created_at,
+                       COALESCE(u.login, 'Unknown User')
+                FROM (
+                    SELECT m.id, m.content, m.sender_id, m.chat_id, m.created_at,
+                           ROW_NUMBER() OVER (PARTITION BY m.chat_id ORDER BY m.id DESC) AS rn
+                    FROM messages m
+                    WHERE m.chat_id IN (SELECT value FROM json_each(?))
+                ) r
+                LEFT JOIN users_db.users u ON u.id = r.sender_id
+                WHERE r.rn <= ?
+                ORDER BY r.chat_id, r.id
+            """, (json.dumps(group), per_chat)):
+                result.setdefault(row[3], []).append(row)
+        finally:
+            conn.close()
+    return result
+
+# Запись messages сообщений в shard_count шардов с параллельными писателями
+async def _bench_ingest(directory: str, shard_count: int, messages: int, chats: int) -> float:
+    bench_shards = []
+    for index in range(shard_count):
+        path = os.path.join(directory, f"bench_{shard_count}_{index}.db")
+        create_shard_schema(path)
+        bench_shards.append(Shard(index, path))
+
+    async def send(number: int):
+        chat_id = number % chats
+        shard = bench_shards[shard_index(chat_id, shard_count)]
+        await shard.write(_insert, shard.index, chat_id, 1, f"message {number}", None)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(number) for number in range(messages)))
+    elapsed = time.perf_counter() - started
+    for shard in bench_shards:
+        shard.close()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Шарды сообщений")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebalance_parser = commands.add_parser("rebalance", help="разложить сообщения по шардам")
+    rebalance_parser.add_argument("--shards", type=int, default=SHARD_COUNT)
+
+    bench_parser = commands.add_parser("bench", help="скорость записи в зависимости от числа шардов")
+    bench_parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    bench_parser.add_argument("--messages", type=int, default=20000)
+    bench_parser.add_argument("--chats", type=int, default=1000)
+
+    args = parser.parse_args()
+    if args.command == "rebalance":
+        moved = rebalance(args.shards)
+        print(f"Перенесено сообщений: {moved}")
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            for shard_count in args.shards:
+                elapsed = asyncio.run(_bench_ingest(directory, shard_count, args.messages, args.chats))
+                print(f"{shard_count} shards: {args.messages / elapsed:,.0f} msg/s")
+
+if __name__ == "__main__":
+    from logs import setup_logging
+    setup_logging()
+    main()
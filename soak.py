@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+from contextlib import ExitStack
+
+# Нагрузочная проверка heartbeat: брошенные WebSocket-подключения не копятся.
+# Приложение поднимается в TestClient во временном каталоге со своими базами,
+# клиенты подключаются к настоящим обработчикам /messages/ws и /chats/ws.
+# Половина клиентов отвечает на ping, остальные молчат, как полуоткрытые
+# соединения. Каждый раунд проверяется, что жнец закрывает молчащих, а после
+# отключения всех клиентов обработчики завершаются и реестры пусты
+
+def _wait_for(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+async def _task_count() -> int:
+    return len(asyncio.all_tasks())
+
+def run(clients: int, rounds: int, timeout: float):
+    from fastapi.testclient import TestClient
+    import auth
+    import heartbeat
+    import main
+    from chat import active_connections
+    from message import connections
+    from ratelimit import connection_limiter
+
+    def registered() -> int:
+        return len(heartbeat.sessions)
+
+    def released() -> bool:
+        return not (heartbeat.sessions or connections or active_connections or connection_limiter.buckets)
+
+    # Одни и те же токены во всех раундах, иначе память растет за счет кеша _decode_token
+    tokens = [auth.create_token(user_id) for user_id in range(1, clients + 1)]
+
+    tracemalloc.start()
+    baseline_memory = None
+    with TestClient(main.app) as client:
+        baseline_tasks = client.portal.call(_task_count)
+        for number in range(rounds):
+            with ExitStack() as stack:
+                live = []
+                started = time.monotonic()
+                for index, token in enumerate(tokens):
+                    path = "/messages/ws/" if index % 4 < 2 else "/chats/ws/"
+                    websocket = stack.enter_context(client.websocket_connect(f"{path}{index + 1}?token={token}"))
+                    # Первый кадр заводит корзину лимитера и у будущих брошенных
+                    websocket.send_json({"type": "pong"})
+                    if index % 2 == 0:
+                        live.append(websocket)
+                # Пока клиенты подключаются, живые еще не отвечают на ping
+                if time.monotonic() - started > timeout / 2:
+                    raise SystemExit(f"Подключение {clients} клиентов заняло больше timeout / 2, увеличьте --timeout")
+                assert _wait_for(lambda: registered() == len(connection_limiter.buckets) == clients, timeout)
+
+                # Живые отвечают на каждый ping, пока жнец не уберет молчащих
+                deadline = time.monotonic() + timeout * 3
+                while registered() > len(live) and time.monotonic() < deadline:
+                    for websocket in live:
+                        assert websocket.receive_json() == {"type": "ping"}
+                        websocket.send_json({"type": "pong"})
+                alive = registered()
+                assert alive == len(live), alive
+                assert len(connections) + len(active_connections) == alive
+                assert len(connection_limiter.buckets) == alive
+            # Выход из ExitStack отключает всех клиентов
+
+            assert _wait_for(released, timeout), (
+                len(heartbeat.sessions), len(connections), len(active_connections),
+                len(connection_limiter.buckets),
+            )
+            # Обработчики всех подключений завершились
+            assert _wait_for(lambda: client.portal.call(_task_count) == baseline_tasks, timeout)
+
+            memory, _ = tracemalloc.get_traced_memory()
+            if baseline_memory is None:
+                baseline_memory = memory
+            print(f"round {number + 1}: reaped {clients - alive}, alive {alive}, "
+                  f"memory {memory / 1024:,.0f} KiB ({(memory - baseline_memory) / 1024:+,.0f} KiB)")
+    tracemalloc.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Брошенные WebSocket-подключения не накапливаются")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=5.0, help="HEARTBEAT_TIMEOUT на время проверки")
+    args = parser.parse_args()
+
+    # Настройки читаются при импорте модулей приложения
+    os.environ["HEARTBEAT_TIMEOUT"] = str(args.timeout)
+    os.environ["HEARTBEAT_INTERVAL"] = str(args.timeout / 4)
+    os.environ["HEARTBEAT_SEND_TIMEOUT"] = str(args.timeout / 4)
+    os.environ["IDLE_TIMEOUT"] = "0"
+    os.environ.setdefault("SECRET_KEY", "soak")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.mkdir("static")
+        run(args.clients, args.rounds, args.timeout)
+
+if __name__ == "__main__":
+    main()
@@ -39,7 +39,7 @@ document.addEventListener("DOMContentLoaded", function () {
             let username = document.getElementById("login-username").value;
             let password = document.getElementById("login-password").value;
 
-            let response = await fetch("/auth/l ogin", {
+            let response = await fetch("/auth/login", {
                 method: "POST",
                 headers: {"Content-Type": "application/json"},
                 body: JSON.stringify({username: username, password: password})